@@ -17,31 +17,61 @@
 
 import sys
 import argparse
-from dataclasses import dataclass
+import functools
+import threading
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import List, Optional, Sequence, Tuple, Union
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
 import requests
-from xml.etree import ElementTree
-from urllib.parse import urljoin
+from requests.adapters import HTTPAdapter
+from urllib.parse import urljoin, urlsplit
 import dateutil.parser
 from time import sleep
 import colorama
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Future, ThreadPoolExecutor
 from enum import Enum
 
+# Prefer lxml for parsing the pack index, as it is considerably faster than ElementTree.
+try:
+    import lxml.etree as ET
+except ImportError:
+    from xml.etree import ElementTree as ET # type: ignore
+
 colorama.init()
 
-@dataclass
+# Terminal colors, left empty when stdout isn't a terminal.
+if sys.stdout.isatty():
+    _RED = colorama.Fore.RED
+    _GREEN = colorama.Fore.GREEN
+    _BRIGHT = colorama.Style.BRIGHT
+    _RESET = colorama.Style.RESET_ALL
+else:
+    _RED = _GREEN = _BRIGHT = _RESET = ""
+
+# Per-pdsc message templates.
+_PDSC_ERROR_MSG = f"{_RED}{{}}{_RESET} [{{}}]"
+_PDSC_STATUS_MSG = f"{_RED}{{}} {_BRIGHT}[{{}}]{_RESET}"
+_PDSC_OK_MSG = f"{_GREEN}{{}}{_RESET}"
+
+# Slotted dataclasses avoid a per-instance __dict__, but require Python 3.10.
+_DATACLASS_SLOTS = {'slots': True} if sys.version_info >= (3, 10) else {}
+
+@dataclass(frozen=True, **_DATACLASS_SLOTS)
 class PdscInfo:
     url: str
     vendor: str
     name: str
     version: str
+    url_full: str = field(init=False, repr=False, compare=False)
 
-    def get_pdsc_url(self) -> str:
+    def __post_init__(self) -> None:
+        # Build the full pdsc URL once, since it's used for the request and all messages.
         prefix_url = self.url if self.url.endswith("/") else self.url + "/"
-        return urljoin(prefix_url, f"{self.vendor}.{self.name}.pdsc")
+        object.__setattr__(self, 'url_full', urljoin(prefix_url, f"{self.vendor}.{self.name}.pdsc"))
+
+    def get_pdsc_url(self) -> str:
+        return self.url_full
 
 class FailureCause(Enum):
     CONNECT_FAILED = 1
@@ -49,12 +79,12 @@ class FailureCause(Enum):
     REQUEST_TIMEOUT = 3
     INVALID_DATA = 4
 
-@dataclass
+@dataclass(frozen=True, **_DATACLASS_SLOTS)
 class RequestFailureInfo:
     url: str
     status: int = -1
     cause: FailureCause = FailureCause.REQUEST_FAILED
-    response: Optional[requests.Response] = None
+    headers: Optional[Dict[str, str]] = None
     pdsc: Optional[PdscInfo] = None
 
 class RequestError(Exception):
@@ -65,124 +95,254 @@ class PackIndexMonitor:
 
     REQUEST_TIMEOUT_SECONDS = 3
 
+    # Size of the chunks in which the pack index is read and fed to the XML parser.
+    INDEX_CHUNK_SIZE = 64 * 1024
+
+    # Index elements of interest. Matched directly against each parsed element's tag.
+    PINDEX_TAG = 'pindex'
+    PDSC_TAG = 'pdsc'
+    TIMESTAMP_TAG = 'timestamp'
+
+    # Response statuses indicating the server doesn't allow HEAD requests.
+    HEAD_UNSUPPORTED_STATUSES = (405, 501)
+
+    # Minimum seconds between progress bar redraws.
+    PROGRESS_MIN_INTERVAL = 0.2
+
+    # Number of per-host connection pools kept alive.
+    POOL_CONNECTIONS = 32
+
     def __init__(self, vendors: Sequence[str], quiet: bool, jobs: int) -> None:
-        self._vendors = vendors
+        self._vendors = frozenset(vendors)
         self._all_vendors = '*' in vendors
+        self._vendor_filter: Optional[Callable[[str], bool]] = \
+                None if self._all_vendors else self._vendors.__contains__
         self._quiet = quiet
         self._jobs = jobs
 
-    def retrieve_index(self) -> Tuple[datetime, List[PdscInfo]]:
+        # Shared session so that requests to the same host reuse kept-alive connections
+        # instead of doing a new TCP and TLS handshake for every pdsc. Each host's pool is
+        # sized to the job count so every concurrent request can return its connection.
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.POOL_CONNECTIONS, pool_maxsize=jobs, max_retries=0)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+        # The worker threads are kept for the lifetime of the monitor rather than per check.
+        self._executor = ThreadPoolExecutor(max_workers=jobs)
+
+    def __enter__(self) -> "PackIndexMonitor":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._executor.shutdown()
+        self._session.close()
+
+    def retrieve_index(self, vendor_filter: Optional[Callable[[str], bool]] = None
+            ) -> Tuple[datetime, List[PdscInfo]]:
+        # If vendor_filter is provided, it is called with the casefolded vendor name of each pdsc,
+        # and only pdscs for which it returns True are included in the result.
         try:
-            idx_response = requests.get(self.PIDX, timeout=self.REQUEST_TIMEOUT_SECONDS)
+            idx_response = self._session.get(self.PIDX, stream=True, timeout=self.REQUEST_TIMEOUT_SECONDS)
         except requests.exceptions.ConnectionError:
             raise RequestError(RequestFailureInfo(url=self.PIDX, cause=FailureCause.CONNECT_FAILED))
         except requests.exceptions.Timeout:
             raise RequestError(RequestFailureInfo(url=self.PIDX, cause=FailureCause.REQUEST_TIMEOUT))
 
-        if not self._quiet:
-            print(f"Pack index response status: {idx_response.status_code}")
-        if idx_response.status_code != 200:
-            if self._quiet:
-                print(f"Failed to retrieve pack index! Response status: {idx_response.status_code}")
-            raise RequestError(RequestFailureInfo(
-                    url=self.PIDX,
-                    status=idx_response.status_code,
-                    response=idx_response,
-                    ))
-
-        # Parse XML
-        try:
-            idx = ElementTree.XML(idx_response.content)
-        except ElementTree.ParseError:
-            raise RequestError(RequestFailureInfo(url=self.PIDX, cause=FailureCause.INVALID_DATA))
+        with idx_response:
+            if not self._quiet:
+                print(f"Pack index response status: {idx_response.status_code}")
+            if idx_response.status_code != 200:
+                if self._quiet:
+                    print(f"Failed to retrieve pack index! Response status: {idx_response.status_code}")
+                raise RequestError(RequestFailureInfo(
+                        url=self.PIDX,
+                        status=idx_response.status_code,
+                        headers=dict(idx_response.headers),
+                        ))
+
+            # Parse XML incrementally as the index is downloaded. Only pdscs that are children of the
+            # root's pindex element and the root's timestamp child are used. The pindex element is
+            # cleared after each pdsc, so the parsed tree doesn't grow with the number of pdscs.
+            ts_iso: Optional[str] = None
+            pdscs: List[PdscInfo] = []
+            total_count = 0
+            parser = ET.XMLPullParser(events=('start', 'end'))
+            # Loop invariants are bound to locals to keep attribute lookups out of the per-element loop.
+            pdsc_tag = self.PDSC_TAG
+            pindex_tag = self.PINDEX_TAG
+            timestamp_tag = self.TIMESTAMP_TAG
+            append_pdsc = pdscs.append
+            # Depth of the current element, with the root at 0, and the open pindex element, if any.
+            depth = -1
+            pindex = None
+            try:
+                for chunk in idx_response.iter_content(self.INDEX_CHUNK_SIZE):
+                    parser.feed(chunk)
+                    for event, elem in parser.read_events():
+                        if event == 'start':
+                            depth += 1
+                            if depth == 1 and elem.tag == pindex_tag:
+                                pindex = elem
+                            continue
+                        if depth == 2 and pindex is not None:
+                            if elem.tag == pdsc_tag:
+                                total_count += 1
+                                attrib = elem.attrib
+                                vendor = attrib['vendor']
+                                if vendor_filter is None or vendor_filter(vendor.casefold()):
+                                    append_pdsc(PdscInfo(
+                                        url=attrib['url'],
+                                        vendor=vendor,
+                                        name=attrib['name'],
+                                        version=attrib['version']
+                                        ))
+                                pindex.clear()
+                        elif depth == 1:
+                            if elem is pindex:
+                                pindex = None
+                            elif ts_iso is None and elem.tag == timestamp_tag:
+                                ts_iso = elem.text or ''
+                        depth -= 1
+                # Raises if the document is incomplete.
+                parser.close()
+            except ET.ParseError:
+                raise RequestError(RequestFailureInfo(url=self.PIDX, cause=FailureCause.INVALID_DATA))
+            except requests.exceptions.ConnectionError:
+                raise RequestError(RequestFailureInfo(url=self.PIDX, cause=FailureCause.CONNECT_FAILED))
+            except requests.exceptions.RequestException:
+                raise RequestError(RequestFailureInfo(url=self.PIDX, cause=FailureCause.REQUEST_FAILED))
 
         # Get timestamp
-        ts_iso = idx.findtext('timestamp')
         if ts_iso is None:
             print("Error: missing index timestamp!")
             raise RequestError(RequestFailureInfo(url=self.PIDX, cause=FailureCause.INVALID_DATA))
-        
-        try:
-            ts = dateutil.parser.isoparse(ts_iso)
-        except dateutil.parser.ParserError:
-            raise RequestError(RequestFailureInfo(url=self.PIDX, cause=FailureCause.INVALID_DATA))
 
-        # Get list of pdscs.
-        pdscs = [
-            PdscInfo(
-                url=e.attrib['url'],
-                vendor=e.attrib['vendor'],
-                name=e.attrib['name'],
-                version=e.attrib['version']
-                )
-            for e in idx.iterfind('pindex/pdsc')
-        ]
+        ts = self._parse_timestamp(ts_iso)
+
+        if not self._quiet:
+            print(f"Timestamp: {ts}")
+            print(f"{total_count} total packs")
 
         return ts, pdscs
 
+    def _parse_timestamp(self, ts_iso: str) -> datetime:
+        # Fast path for plain ISO 8601 timestamps; dateutil handles anything else.
+        try:
+            return datetime.fromisoformat(ts_iso.replace('Z', '+00:00'))
+        except ValueError:
+            pass
+        try:
+            return dateutil.parser.isoparse(ts_iso)
+        except ValueError:
+            raise RequestError(RequestFailureInfo(url=self.PIDX, cause=FailureCause.INVALID_DATA))
+
     def retrieve_pdsc(self, pdsc: PdscInfo) -> Union[requests.Response, RequestFailureInfo]:
+        # Only the status is checked, so a HEAD request is enough and avoids downloading the pdsc.
+        # For servers that don't support HEAD, fall back to a streamed GET and drop the body.
         try:
-            return requests.get(pdsc.get_pdsc_url(), timeout=self.REQUEST_TIMEOUT_SECONDS)
+            response = self._session.head(pdsc.url_full, allow_redirects=True,
+                    timeout=self.REQUEST_TIMEOUT_SECONDS)
+            if response.status_code in self.HEAD_UNSUPPORTED_STATUSES:
+                response = self._session.get(pdsc.url_full, stream=True,
+                        timeout=self.REQUEST_TIMEOUT_SECONDS)
+                response.close()
+            return response
         except requests.exceptions.ConnectionError:
-            return RequestFailureInfo(url=pdsc.get_pdsc_url(), cause=FailureCause.CONNECT_FAILED)
+            return RequestFailureInfo(url=pdsc.url_full, cause=FailureCause.CONNECT_FAILED)
         except requests.exceptions.Timeout:
-            return RequestFailureInfo(url=pdsc.get_pdsc_url(), cause=FailureCause.REQUEST_TIMEOUT)
+            return RequestFailureInfo(url=pdsc.url_full, cause=FailureCause.REQUEST_TIMEOUT)
+        except requests.exceptions.RequestException:
+            return RequestFailureInfo(url=pdsc.url_full, cause=FailureCause.REQUEST_FAILED)
 
     def check_pdscs(self) -> List[RequestFailureInfo]:
         try:
-            ts, pdscs = self.retrieve_index()
+            _, filtered_pdscs = self.retrieve_index(self._vendor_filter)
         except RequestError as err:
             return [err.args[0]]
 
-        if not self._quiet:
-            print(f"Timestamp: {ts}")
-            print(f"{len(pdscs)} total packs")
-
-        if self._all_vendors:
-            filtered_pdscs = pdscs
-        else:
-            filtered_pdscs = [
-                p
-                for p in pdscs
-                if p.vendor.casefold() in self._vendors
-            ]
         if not self._quiet:
             print(f"{len(filtered_pdscs)} monitored packs")
 
-        failures: List[RequestFailureInfo] = []
+        # The index can list the same pdsc URL more than once; only check each URL once.
+        unique_pdscs = list({p.url_full: p for p in filtered_pdscs}.values())
 
-        with ThreadPoolExecutor(max_workers=self._jobs) as executor:
-            futures_map = {
-                executor.submit(requests.get, pdsc.get_pdsc_url()): pdsc
-                for pdsc in filtered_pdscs
-            }
-
-            if sys.stdout.isatty():
-                futures_iter = tqdm(as_completed(futures_map), total=len(filtered_pdscs), unit="pack")
-                msg_file = futures_iter
-            else:
-                futures_iter = futures_map
-                msg_file = sys.stdout
-
-            for future in futures_iter:
-                pdsc = futures_map[future]
-                pdsc_url = pdsc.get_pdsc_url()
+        failures: List[RequestFailureInfo] = []
+        lock = threading.Lock()
+        all_done = threading.Event()
+        remaining = len(unique_pdscs)
+        if not remaining:
+            all_done.set()
+        # First exception raised while recording a result, re-raised on the calling thread.
+        callback_error: Optional[Exception] = None
+
+        # Results are collected by a done callback on each future, which runs on the worker
+        # thread as soon as the request completes.
+        def pdsc_done(pdsc: PdscInfo, progress: tqdm, future: Future) -> None:
+            nonlocal remaining, callback_error
+            pdsc_url = pdsc.url_full
+            failure: Optional[RequestFailureInfo] = None
+            msg: Optional[str] = None
+            try:
                 response = future.result()
                 if isinstance(response, RequestFailureInfo):
-                    failures.append(response)
-                    msg_file.write(f"{colorama.Fore.RED}{pdsc_url}{colorama.Style.RESET_ALL} [{response.cause.name}]")
+                    failure = response
+                    msg = _PDSC_ERROR_MSG.format(pdsc_url, response.cause.name)
                 elif response.status_code != 200:
-                    failures.append(RequestFailureInfo(
+                    # Keep only the headers for the log, and release the response.
+                    failure = RequestFailureInfo(
                         url=pdsc_url,
                         status=response.status_code,
                         cause=FailureCause.REQUEST_FAILED,
-                        response=response,
+                        headers=dict(response.headers),
                         pdsc=pdsc,
-                        ))
-                    msg_file.write(f"{colorama.Fore.RED}{pdsc_url} "
-                                   f"{colorama.Style.BRIGHT}[{response.status_code}]{colorama.Style.RESET_ALL}")
+                        )
+                    response.close()
+                    msg = _PDSC_STATUS_MSG.format(pdsc_url, response.status_code)
                 elif not self._quiet:
-                    msg_file.write(f"{colorama.Fore.GREEN}{pdsc_url}{colorama.Style.RESET_ALL}")
+                    msg = _PDSC_OK_MSG.format(pdsc_url)
+            except Exception as exc:
+                # Never report a pdsc as accessible if its check failed unexpectedly.
+                failure = RequestFailureInfo(url=pdsc_url, cause=FailureCause.REQUEST_FAILED, pdsc=pdsc)
+                msg = _PDSC_ERROR_MSG.format(pdsc_url, f"{type(exc).__name__}: {exc}")
+            finally:
+                with lock:
+                    # The count must always go down, even if writing the message fails, or the
+                    # wait for all results would never return.
+                    try:
+                        if failure is not None:
+                            failures.append(failure)
+                        if msg is not None:
+                            progress.write(msg)
+                        progress.update()
+                    except Exception as exc:
+                        if callback_error is None:
+                            callback_error = exc
+                    finally:
+                        remaining -= 1
+                        if not remaining:
+                            all_done.set()
+
+        # Submit grouped by host, so same-host requests pick up idle connections from the pool
+        # rather than evicting other hosts' pools.
+        submit_order = sorted(unique_pdscs, key=lambda p: urlsplit(p.url).netloc)
+
+        # The progress bar is only shown on a tty. Messages are always written through tqdm so
+        # they don't clobber the bar. Redraws are limited to about every 1% of packs and at
+        # least PROGRESS_MIN_INTERVAL apart, rather than on every completed request.
+        total = len(unique_pdscs)
+        with tqdm(total=total, unit="pack", disable=not sys.stdout.isatty(),
+                    miniters=max(1, total // 100), mininterval=self.PROGRESS_MIN_INTERVAL) as progress:
+            for pdsc in submit_order:
+                future = self._executor.submit(self.retrieve_pdsc, pdsc)
+                future.add_done_callback(functools.partial(pdsc_done, pdsc, progress))
+            all_done.wait()
+
+        if callback_error is not None:
+            raise callback_error
 
         return failures
 
@@ -190,6 +350,8 @@ class PackIndexMonitor:
 class PackIndexMonitorTool:
     DEFAULT_VENDORS = ["Keil"]
 
+    LOG_BUFFER_SIZE = 1 << 20
+
     def __init__(self) -> None:
         self._parser = self._build_parser()
     
@@ -211,6 +373,7 @@ class PackIndexMonitorTool:
     
     def run(self) -> None:
         args = self._parser.parse_args()
+        logfile = None
 
         try:
             if args.jobs < 1 or args.jobs > 1000:
@@ -218,50 +381,50 @@ class PackIndexMonitorTool:
                 return
 
             if args.log:
-                logfile = open(args.log, 'a')
-            else:
-                logfile = None
+                # Large buffer, flushed at the end of each check.
+                logfile = open(args.log, 'a', buffering=self.LOG_BUFFER_SIZE)
 
             vendors = [
                 vendor.strip().casefold()
                 for vendor in (args.vendors or self.DEFAULT_VENDORS)
                 ]
 
-            mon = PackIndexMonitor(vendors, args.quiet, args.jobs)
-
-            while True:
-                now = datetime.now()
-                if logfile:
-                    logfile.write(f"{now}: Started checking index\n")
-
-                failures = mon.check_pdscs()
-                now = datetime.now()
-                if failures:
-                    print(f"{now}: {colorama.Fore.RED}{len(failures)} failures{colorama.Style.RESET_ALL}")
+            with PackIndexMonitor(vendors, args.quiet, args.jobs) as mon:
+                while True:
+                    now = datetime.now()
                     if logfile:
-                        logfile.write(f"{now}: {len(failures)} failures\n")
+                        logfile.write(f"{now}: Started checking index\n")
 
-                    for fail in failures:
+                    failures = mon.check_pdscs()
+                    now = datetime.now()
+                    if failures:
+                        print(f"{now}: {_RED}{len(failures)} failures{_RESET}")
                         if logfile:
-                            logfile.write(f"    {fail.status} {fail.url}\n")
-                            if fail.response is not None:
-                                for hk, hv in fail.response.headers.items():
-                                    logfile.write(f"        {hk}: {hv}\n")
-                else:
-                    print(f"{now}: {colorama.Fore.GREEN}No failures!{colorama.Style.RESET_ALL}")
-                    if logfile:
-                        logfile.write(f"{now}: No failures!\n")
+                            lines: List[str] = [f"{now}: {len(failures)} failures\n"]
+                            for fail in failures:
+                                lines.append(f"    {fail.status} {fail.url}\n")
+                                if fail.headers is not None:
+                                    lines.extend(f"        {hk}: {hv}\n" for hk, hv in fail.headers.items())
+                            logfile.writelines(lines)
+                    else:
+                        print(f"{now}: {_GREEN}No failures!{_RESET}")
+                        if logfile:
+                            logfile.write(f"{now}: No failures!\n")
 
-                if logfile:
-                    now = datetime.now()
-                    logfile.write(f"{now}: Finished checking index\n")
+                    if logfile:
+                        now = datetime.now()
+                        logfile.write(f"{now}: Finished checking index\n")
+                        logfile.flush()
 
-                if args.interval == 0:
-                    break
-                sleep(args.interval)
+                    if args.interval == 0:
+                        break
+                    sleep(args.interval)
 
         except KeyboardInterrupt:
             print("Interrupted by user")
+        finally:
+            if logfile:
+                logfile.close()
 
 
 if __name__ == '__main__':